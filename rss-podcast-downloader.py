@@ -1,12 +1,20 @@
 import requests
 import feedparser
-import re
-from datetime import datetime
+import hashlib
+import io
 import os
 import argparse
-import time
 import logging
-from urllib.parse import urlparse, unquote
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
+from lxml import etree
+from tqdm import tqdm
+from tqdm.contrib.logging import logging_redirect_tqdm
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 """
 RSS Downloader Script
@@ -44,57 +52,281 @@ Author: John Sosoka
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Number of episodes downloaded in parallel, and size of the HTTP connection pool shared by them
+MAX_WORKERS = 8
+POOL_SIZE = 16
+
+# Connect / read timeouts in seconds, and the buffer size used when streaming downloads to disk
+TIMEOUT = (5, 60)
+CHUNK_SIZE = 1024 * 1024
+
+# Translation table that strips characters not allowed in filenames and turns spaces into underscores
+FILENAME_TRANSLATION = str.maketrans({**{c: None for c in '\\/*?:"<>|'}, ' ': '_'})
+
+ITUNES_NS = '{http://www.itunes.com/dtds/podcast-1.0.dtd}'
+
+# Statuses the server uses to push back, and the request rate all workers share once it does
+THROTTLE_STATUSES = (429, 503)
+RATE_LIMIT = 8
+# Seconds without throttling responses before the rate limit is lifted again
+THROTTLE_QUIET_PERIOD = 60
+# Longest Retry-After delay honoured; requests asked to wait longer fail instead of stalling the run
+MAX_RETRY_AFTER = 300
+
+# Set on Ctrl+C so in-flight downloads stop at their next chunk instead of running to completion
+stop_downloads = threading.Event()
+
+class DownloadCancelled(Exception):
+    """Raised inside a worker when the run is being shut down."""
+
+class ServerThrottled(requests.RequestException):
+    """Raised when the server asks for a longer pause than MAX_RETRY_AFTER; such requests are not retried."""
+
+class RateLimiter:
+    """
+    Sliding-window rate limiter shared by all workers. It stays idle until engaged, after which
+    at most `rate` requests are sent per second until `quiet_period` seconds pass without
+    another engage().
+    """
+
+    def __init__(self, rate=RATE_LIMIT, quiet_period=THROTTLE_QUIET_PERIOD):
+        self.rate = rate
+        self.quiet_period = quiet_period
+        self.engaged = False
+        self.last_engaged = 0.0
+        self.blocked_until = 0.0
+        self.window = deque()
+        self.lock = threading.Lock()
+
+    def block(self, seconds):
+        """Stop all requests for `seconds`, as asked by a Retry-After that is too long to wait out."""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def blocked_for(self):
+        """Return how many seconds remain of a block() pause, or 0."""
+        return max(0.0, self.blocked_until - time.monotonic())
+
+    def engage(self):
+        with self.lock:
+            self.last_engaged = time.monotonic()
+            if not self.engaged:
+                logging.warning(f"Server is throttling requests, limiting to {self.rate} requests per second")
+                self.engaged = True
+
+    def wait(self):
+        """Block until another request may be sent."""
+        if not self.engaged:
+            return
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_engaged > self.quiet_period:
+                logging.info("Server stopped throttling requests, lifting the rate limit")
+                self.engaged = False
+                self.window.clear()
+                return
+            while self.window and self.window[0] <= now - 1:
+                self.window.popleft()
+            if len(self.window) >= self.rate:
+                time.sleep(self.window[0] + 1 - now)
+                self.window.popleft()
+            self.window.append(time.monotonic())
+
+def retry_after_seconds(response):
+    """Return the delay requested by a Retry-After header (seconds or HTTP date), or None."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class ThrottledSession(requests.Session):
+    """
+    Session that only paces requests once the server pushes back: a 429/503 response engages the
+    shared rate limiter and the request is retried after the Retry-After delay (or exponential backoff).
+    Delays longer than MAX_RETRY_AFTER are not waited out: the request raises ServerThrottled, and so
+    does every later request until that delay has passed, without contacting the server.
+    """
+
+    def __init__(self, rate_limiter=None, retries=3):
+        super().__init__()
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.retries = retries
+
+    def request(self, method, url, *args, **kwargs):
+        remaining = self.rate_limiter.blocked_for()
+        if remaining:
+            raise ServerThrottled(f"Server asked to pause requests for another {remaining:.0f} seconds: {url}")
+        for attempt in range(1, self.retries + 1):
+            self.rate_limiter.wait()
+            response = super().request(method, url, *args, **kwargs)
+            if response.status_code not in THROTTLE_STATUSES:
+                return response
+            self.rate_limiter.engage()
+            delay = retry_after_seconds(response)
+            if delay is None:
+                delay = 2 ** attempt
+            elif delay > MAX_RETRY_AFTER:
+                response.close()
+                self.rate_limiter.block(delay)
+                raise ServerThrottled(f"Got HTTP {response.status_code} with Retry-After of {delay:.0f} seconds: {url}",
+                                      response=response)
+            logging.warning(f"Got HTTP {response.status_code} for {url}, retrying in {delay:.0f} seconds...")
+            response.close()
+            if stop_downloads.wait(delay):
+                raise DownloadCancelled(url)
+        self.rate_limiter.wait()
+        return super().request(method, url, *args, **kwargs)
+
+def create_session(pool_size=POOL_SIZE, retries=3):
+    """
+    Create a requests session that reuses keep-alive connections. Connection errors and
+    500/502/504 responses are retried by urllib3 after 0, 4 and 8 seconds; other HTTP errors
+    and failures while reading the body are retried by download_file. Throttling responses
+    are handled by the session itself so every worker slows down together.
+    """
+    session = ThrottledSession(retries=retries)
+    # Leave Retry-After handling to the session, otherwise urllib3 would silently absorb throttling responses
+    retry = Retry(total=retries, backoff_factor=2, status_forcelist=(500, 502, 504), respect_retry_after_header=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
 def sanitize_title(title, date_str=None):
     """
     Convert a podcast episode title to a filesystem-friendly filename,
     prepending the date in the format (YYYY-MM-DD) if provided.
     """
-    # Remove characters that are not allowed in filenames
-    sanitized_title = re.sub(r'[\\/*?:"<>|]', '', title)
-
-    # Replace spaces with underscores for readability
-    sanitized_title = sanitized_title.replace(' ', '_').lower()
+    # Remove characters that are not allowed in filenames and replace spaces with underscores for readability
+    sanitized_title = title.translate(FILENAME_TRANSLATION).lower()
 
     # Prepend date in the specified format if provided
     if date_str:
         try:
-            date = datetime.strptime(date_str, '%a, %d %b %Y %H:%M:%S %Z')
+            # RSS dates are RFC 822, e.g. 'Tue, 04 Jun 2024 08:00:00 GMT'
+            date = parsedate_to_datetime(date_str)
             date_formatted = date.strftime('%Y-%m-%d')
             sanitized_title = f'{date_formatted}_{sanitized_title}'
-        except ValueError as e:
+        except (TypeError, ValueError) as e:
             logging.error(f"Error parsing date: {e}")
 
     return sanitized_title
 
-def download_file(url, filename, retries=3):
+def remote_file_size(session, url):
+    """Return the Content-Length reported by a HEAD request, or None if the server doesn't provide one."""
+    try:
+        response = session.head(url, allow_redirects=True, timeout=TIMEOUT)
+    except requests.RequestException as e:
+        logging.warning(f"Could not check the size of {url}: {e}")
+        return None
+    if not response.ok:
+        return None
+    try:
+        return int(response.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return None
+
+def content_range_start(response):
+    """Return the first byte offset of a 206 response's Content-Range header, or None if it is missing."""
+    # Content-Range: bytes <start>-<end>/<total>
+    unit, _, byte_range = response.headers.get('Content-Range', '').partition(' ')
+    start, dash, _ = byte_range.partition('-')
+    if unit != 'bytes' or not dash or not start.isdigit():
+        return None
+    return int(start)
+
+def episode_key(entry, url):
+    """
+    Return a short digest that identifies an episode's enclosure across runs, based on the entry's
+    guid and the URL path (query strings often carry per-request tokens).
+    """
+    identity = f"{entry.get('id', '')}|{url.split('?', 1)[0]}"
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()[:8]
+
+def file_extension(url, default='.mp3'):
+    """Return the file extension of a URL's path, ignoring any query string or fragment."""
+    path = url.split('?', 1)[0].split('#', 1)[0]
+    _, dot, extension = path.rpartition('.')
+    return dot + extension if dot and '/' not in extension else default
+
+def stream_to_file(session, url, filename, key):
+    """
+    Stream a file from a given URL to disk. Data goes to a '<filename>.<key>.part' file that is renamed
+    into place once complete, so a file at `filename` is always a finished download. Finished files are
+    skipped unless the server reports a different size, and partial files are resumed with a Range
+    request. Raises on any network or disk error.
+    """
+    if os.path.exists(filename):
+        remote_size = remote_file_size(session, url)
+        if remote_size is None or remote_size == os.path.getsize(filename):
+            logging.info(f"Already downloaded, skipping: {filename}")
+            return
+        logging.info(f"File size on the server differs, downloading again: {filename}")
+
+    # The part file is tied to this episode, so an episode that later takes over the same filename
+    # (e.g. a new upload with the same title and date) never appends to another episode's data
+    part_filename = f"{filename}.{key}.part"
+    headers = {}
+    local_size = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+    if local_size:
+        headers['Range'] = f'bytes={local_size}-'
+
+    response = session.get(url, headers=headers, stream=True, timeout=TIMEOUT)
+    if headers and (response.status_code == 416
+                    or response.status_code == 206 and content_range_start(response) != local_size):
+        logging.warning(f"Server did not return the expected range, downloading in full: {filename}")
+        response.close()
+        headers = {}
+        response = session.get(url, stream=True, timeout=TIMEOUT)
+
+    with response:
+        response.raise_for_status()
+        # Append only if the server honoured the Range request, otherwise start over
+        resuming = bool(headers) and response.status_code == 206
+        if resuming:
+            logging.info(f"Resuming download at byte {local_size}: {filename}")
+        # iter_content decodes any Content-Encoding and wraps mid-body failures in requests exceptions
+        with open(part_filename, 'ab' if resuming else 'wb') as file:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if stop_downloads.is_set():
+                    raise DownloadCancelled(url)
+                file.write(chunk)
+    os.replace(part_filename, filename)
+
+def download_file(session, url, filename, key, retries=3):
     """Download a file from a given URL with retry logic."""
-    attempt = 0
-    while attempt < retries:
+    for attempt in range(1, retries + 1):
         try:
-            response = requests.get(url)
-            response.raise_for_status()
-            with open(filename, 'wb') as file:
-                file.write(response.content)
-            if attempt > 0:
-                logging.info(f"Download succeeded after {attempt} retry(ies): {filename}")
-            else:
-                logging.info(f"Downloaded: {filename}")
+            stream_to_file(session, url, filename, key)
+            if attempt > 1:
+                logging.info(f"Download succeeded after {attempt - 1} retry(ies): {filename}")
             return True
-        except requests.RequestException as e:
-            attempt += 1
+        except DownloadCancelled:
+            return False
+        except (requests.RequestException, OSError) as e:
+            # Don't retry throttling: the session already backed off, or the server asked for a long pause
+            response = getattr(e, 'response', None)
+            if isinstance(e, ServerThrottled) or (response is not None and response.status_code in THROTTLE_STATUSES):
+                logging.error(f"Failed to download {url}, server is throttling requests: {e}")
+                return False
             logging.warning(f"Error downloading file (attempt {attempt}/{retries}): {e}")
             if attempt < retries:
-                sleep_time = 2 ** attempt  # Exponential backoff: 2, 4, 8 seconds
+                sleep_time = 2 ** attempt  # Exponential backoff: 2, 4 seconds
                 logging.info(f"Retrying in {sleep_time} seconds...")
-                time.sleep(sleep_time)
-            else:
-                logging.error(f"Failed to download {url} after {retries} attempts.")
+                if stop_downloads.wait(sleep_time):
+                    return False
+    logging.error(f"Failed to download {url} after {retries} attempts.")
     return False
 
-def fetch_rss_feed(url):
+def fetch_rss_feed(session, url):
     """Fetch the content of the RSS feed."""
     try:
-        response = requests.get(url)
+        response = session.get(url, timeout=TIMEOUT)
         response.raise_for_status()
         return response.content
     except requests.RequestException as e:
@@ -105,44 +337,142 @@ def fetch_rss_feed(url):
 
 def save_text_file(entry, filename):
     """Save podcast details in a text file."""
-    with open(f"{filename}.txt", 'w') as file:
-        file.write(f"Title: {entry.get('title', 'N/A')}\n")
-        file.write(f"Subtitle: {entry.get('subtitle', 'N/A')}\n")
-        file.write(f"Published Date: {entry.get('published', 'N/A')}\n")
-        file.write(f"Content: {entry.get('summary', 'N/A')}\n")
+    payload = (
+        f"Title: {entry.get('title', 'N/A')}\n"
+        f"Subtitle: {entry.get('subtitle', 'N/A')}\n"
+        f"Published Date: {entry.get('published', 'N/A')}\n"
+        f"Content: {entry.get('summary', 'N/A')}\n"
+    ).encode('utf-8')
+    fd = os.open(f"{filename}.txt", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, payload)
+    finally:
+        os.close(fd)
 
-def parse_and_download(content, save_dir, save_text):
-    """Parse the RSS feed and download files."""
-    feed = feedparser.parse(content)
+def feed_root_tag(content):
+    """Return the tag of the feed's root element without parsing the rest of the document."""
+    for _, element in etree.iterparse(io.BytesIO(content), events=('start',), recover=True, resolve_entities=False):
+        return element.tag
+    return None
 
-    # Count total audio files
-    total_audio_files = sum(1 for entry in feed.entries if any(link.type == 'audio/mpeg' for link in entry.get('links', [])))
-    logging.info(f"Total audio files to download: {total_audio_files}")
+def parse_rss_items(content):
+    """
+    Yield the episode fields used by the downloader from an RSS 2.0 feed as each item is parsed.
+
+    Entries use the same keys as feedparser ('id', 'title', 'subtitle', 'published', 'summary' and
+    'links' with 'href' / 'type') so either parser can drive the downloader.
+    """
+    item_count = 0
+    # No recover=True: libxml2's recovery silently truncates text at HTML entities such as &eacute;
+    items = etree.iterparse(io.BytesIO(content), events=('end',), tag='item', resolve_entities=False)
+    try:
+        for _, item in items:
+            fields = {
+                'id': item.findtext('guid'),
+                'title': item.findtext('title'),
+                'subtitle': item.findtext(f'{ITUNES_NS}subtitle'),
+                'published': item.findtext('pubDate'),
+                'summary': item.findtext('description') or item.findtext(f'{ITUNES_NS}summary'),
+            }
+            entry = {key: value.strip() for key, value in fields.items() if value}
+            entry['links'] = [{'href': enclosure.get('url'), 'type': enclosure.get('type')}
+                              for enclosure in item.iterfind('enclosure') if enclosure.get('url')]
+
+            # Free parsed items as we go so memory stays flat on large feeds
+            item.clear()
+            while item.getprevious() is not None:
+                del item.getparent()[0]
+            item_count += 1
+            yield entry
+    except etree.XMLSyntaxError as e:
+        # Items parsed so far are already downloading, so let the more lenient feedparser handle the rest
+        logging.warning(f"Error parsing the RSS feed after {item_count} item(s), "
+                        f"parsing the remaining items with feedparser: {e}")
+        yield from feedparser.parse(content).entries[item_count:]
+        return
+
+    if not item_count:
+        logging.warning("No <item> entries found in the feed, try again with --legacy-parser")
+
+def parse_feed(content, legacy_parser=False):
+    """Parse the RSS feed into an iterable of episode entries."""
+    if legacy_parser:
+        return feedparser.parse(content).entries
+
+    try:
+        root_tag = feed_root_tag(content)
+    except etree.XMLSyntaxError:
+        root_tag = None
+    if root_tag is None:
+        logging.error("Error parsing the RSS feed: the response is not an XML document")
+        logging.error("Please check the URL and authentication token (if applicable)")
+        logging.error("Exiting...")
+        exit(1)
+
+    # The lxml parser only understands RSS 2.0, leave Atom / RSS 1.0 feeds to feedparser
+    if root_tag != 'rss':
+        logging.warning(f"Feed root is <{root_tag}> rather than <rss>, falling back to feedparser")
+        entries = feedparser.parse(content).entries
+        if not entries:
+            logging.warning("No entries found in the feed")
+        return entries
+    return parse_rss_items(content)
+
+def iter_download_jobs(entries, save_dir):
+    """Yield a (url, filename, key, entry) download job for every audio link in the feed entries."""
+    # save_dir is fixed for the whole run, so resolve the directory prefix once
+    prefix = os.path.join(save_dir, '')
+    # Jobs run concurrently, so two jobs writing the same file would interleave their bytes
+    seen_filenames = set()
+    for entry in entries:
+        for link in entry.get('links', ()):
+            if link.get('type') != 'audio/mpeg':
+                continue
+            date_str = entry.get('published', None)
+            title = sanitize_title(entry.get('title', ''), date_str)
+
+            url = link['href']
+            key = episode_key(entry, url)
+            extension = file_extension(url)
+            filename = f"{prefix}{title}{extension}"
+            # Repeats (shared title and date, or several enclosures per episode) get the episode key as a
+            # suffix, which doesn't change when the feed order does
+            if filename in seen_filenames:
+                filename = f"{prefix}{title}_{key}{extension}"
+                if filename in seen_filenames:
+                    logging.info(f"Skipping duplicate enclosure: {url}")
+                    continue
+            seen_filenames.add(filename)
+            yield url, filename, key, entry
+
+def parse_and_download(session, content, save_dir, save_text, workers=MAX_WORKERS, legacy_parser=False):
+    """Parse the RSS feed and download files concurrently."""
+    entries = parse_feed(content, legacy_parser)
 
-    audio_file_counter = 0
     successful_downloads = 0
-    for entry in feed.entries:
-        if 'links' in entry:
-            for link in entry.links:
-                if link.type == 'audio/mpeg':
-                    audio_file_counter += 1
-                    date_str = entry.get('published', None)
-                    title = sanitize_title(entry.title, date_str)
-
-                    # Parse URL for file extension / remove Query String, etc.
-                    parsed_url = urlparse(unquote(link.href))
-                    _, file_extension = os.path.splitext(parsed_url.path)
-                    filename = os.path.join(save_dir, title + file_extension)
-
-                    # Attempt to download the file
-                    if download_file(link.href, filename):
+    # Route log records through tqdm so messages from worker threads don't tear the progress bar
+    with ThreadPoolExecutor(max_workers=workers) as executor, logging_redirect_tqdm():
+        try:
+            # Jobs are submitted as soon as they are parsed, so downloads start while the rest of the feed is read
+            futures = {executor.submit(download_file, session, url, filename, key): (filename, entry)
+                       for url, filename, key, entry in iter_download_jobs(entries, save_dir)}
+            total_audio_files = len(futures)
+            logging.info(f"Total audio files to download: {total_audio_files}")
+            with tqdm(total=total_audio_files, unit='file') as progress:
+                for future in as_completed(futures):
+                    filename, entry = futures[future]
+                    if future.result():
                         successful_downloads += 1
                         if save_text:
-                            logging.info(f"Saving additional details in text file {filename}")
                             save_text_file(entry, filename)
-                    logging.info(f"Downloading audio file {audio_file_counter} of {total_audio_files}")
-                    logging.info("Sleeping for 1 second...")
-                    time.sleep(1)
+                    progress.update(1)
+                    progress.set_postfix_str(os.path.basename(filename))
+        except BaseException:
+            # On Ctrl+C (or any error) drop queued downloads and stop running ones instead of letting the
+            # executor finish the whole feed; partial files are resumed on the next run
+            stop_downloads.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
     logging.info("Completed! Successfully downloaded {} / {} audio files".format(successful_downloads, total_audio_files))
 
 def main():
@@ -150,11 +480,19 @@ def main():
     parser.add_argument('rss_url', help='RSS feed URL (Include authentication token if applicable)')
     parser.add_argument('save_dir', help='Directory to save downloaded files')
     parser.add_argument('--save_text', action='store_true', help='Flag to save text files with extra episode data')
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS,
+                        help=f'Number of episodes to download in parallel (default: {MAX_WORKERS})')
+    parser.add_argument('--legacy-parser', action='store_true',
+                        help='Always parse the feed with feedparser instead of lxml (slower, but more lenient)')
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
 
-    content = fetch_rss_feed(args.rss_url)
+    # Keep at least one pooled connection per worker so none of them has to open a fresh socket
+    session = create_session(pool_size=max(POOL_SIZE, args.workers))
+    content = fetch_rss_feed(session, args.rss_url)
     if content:
-        parse_and_download(content, args.save_dir, args.save_text)
+        parse_and_download(session, content, args.save_dir, args.save_text, args.workers, args.legacy_parser)
 
 if __name__ == "__main__":
     main()